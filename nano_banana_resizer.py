@@ -5,75 +5,281 @@ Final version with AR detection, fixed buckets, ceiling logic for dynamic
 resizing, and manual override for ambiguous bucket zones.
 """
 
-from typing import Tuple, List
-import math
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import FrozenSet, Optional, Tuple
 
-class NanoBananaSizeCalculator:
-    # Supported Aspect Ratios for Nano Banana/Gemini API (W:H format)
-    SUPPORTED_ARS = {
-        "1:1": 1.0, 
-        "3:2": 1.5, 
-        "2:3": 0.666667, # Precise 2/3
-        "3:4": 0.75, 
-        "4:3": 1.333333, # Precise 4/3
-        "4:5": 0.8, 
-        "5:4": 1.25, 
-        "9:16": 0.5625, 
-        "16:9": 1.777778, # Precise 16/9
-        "21:9": 2.333333
+# Optional: numba compiles the bucket scan to native code. Without it the
+# pure-Python loop in _closest_bucket is used.
+try:
+    import numpy as np
+    from numba import njit
+except ImportError:
+    np = None
+    njit = None
+
+# ──────────────────────────────────────────────────────────────
+# BUCKETS (Unchanged from final fix)
+# Shared, immutable tables: the node classes reference these, never copy them.
+# ──────────────────────────────────────────────────────────────
+BUCKETS_NB1: Tuple[Tuple[int, int], ...] = (
+    (512, 2048), (576, 1792), (736, 1408), (768, 1344), (800, 1280),
+    (832, 1248), (864, 1184), (896, 1152), (928, 1120), (960, 1088),
+    (1024, 1024), (1088, 960), (1120, 928), (1152, 896), (1184, 864),
+    (1248, 832), (1280, 800), (1344, 768), (1408, 736), (1472, 704),
+    (1792, 576), (2048, 512),
+)
+
+BUCKETS_NB2_1K: Tuple[Tuple[int, int], ...] = (
+    (768, 1344), (800, 1280), (832, 1248), (864, 1184), (896, 1152),
+    (928, 1120), (960, 1088), (992, 1056), (1024, 1024), (1056, 992),
+    (1088, 960), (1120, 928), (1152, 896), (1184, 864), (1248, 832),
+    (1280, 800), (1344, 768),
+)
+
+BUCKETS_NB2_2K: Tuple[Tuple[int, int], ...] = (
+    (1024, 4096), (1088, 3840), (1152, 3584), (1216, 3328), (1280, 3072),
+    (1344, 2816), (1408, 2560), (1472, 2816), (1536, 2688), (1600, 2560),
+    (1664, 2496), (1696, 2528), (1728, 2368), 
+    (1760, 2432), (2432, 1760), 
+    (1792, 2304), (1856, 2240),
+    (1920, 2176), (1984, 2048), (2048, 2048), (2176, 1920), (2240, 1856),
+    (2304, 1792), (2368, 1728), (2496, 1664), (2560, 1600), (2688, 1536),
+    (2816, 1472), (3072, 1280), (3328, 1216), (3584, 1152), (3840, 1088),
+    (4096, 1024),
+)
+
+BUCKETS_NB2_4K: Tuple[Tuple[int, int], ...] = (
+    (2048, 8192), (2176, 7680), (2304, 7168), (2432, 6656), (2560, 6144),
+    (2688, 5632), (2816, 5120), (2944, 5632), (3072, 5376), (3200, 5120),
+    (3328, 4992), (3392, 5056), (3456, 4736), (3584, 4608), (3712, 4480),
+    (3840, 4352), (3968, 4096), (4096, 4096), (4352, 3840), (4480, 3712),
+    (4608, 3584), (4736, 3456), (4992, 3328), (5120, 3200), (5376, 3072),
+    (5632, 2944), (6144, 2560), (6656, 2432), (7168, 2304), (7680, 2176),
+    (8192, 2048),
+)
+
+# Preset name -> (bucket table, label used in the info string)
+PRESET_TABLE = {
+    "Nano Banana 1": (BUCKETS_NB1, "Nano Banana 1"),
+    "Nano Banana 2 (1K)": (BUCKETS_NB2_1K, "Nano Banana 2 (1K)"),
+    "Nano Banana 2 (2K)": (BUCKETS_NB2_2K, "Nano Banana 2 (2K)"),
+    "Nano Banana 2 (4K)": (BUCKETS_NB2_4K, "Nano Banana 2 (4K)"),
+}
+
+# Per-preset bucket sets for the exact-match fast path in _closest_bucket
+_BUCKET_SET_NB1 = frozenset(BUCKETS_NB1)
+_BUCKET_SET_NB2_1K = frozenset(BUCKETS_NB2_1K)
+_BUCKET_SET_NB2_2K = frozenset(BUCKETS_NB2_2K)
+_BUCKET_SET_NB2_4K = frozenset(BUCKETS_NB2_4K)
+
+BUCKET_SET_TABLE = {
+    "Nano Banana 1": _BUCKET_SET_NB1,
+    "Nano Banana 2 (1K)": _BUCKET_SET_NB2_1K,
+    "Nano Banana 2 (2K)": _BUCKET_SET_NB2_2K,
+    "Nano Banana 2 (4K)": _BUCKET_SET_NB2_4K,
+}
+
+if njit is not None:
+    # int64 so squared distances of very large inputs can't overflow
+    _NP_NB1 = np.ascontiguousarray(BUCKETS_NB1, dtype=np.int64)
+    _NP_NB2_1K = np.ascontiguousarray(BUCKETS_NB2_1K, dtype=np.int64)
+    _NP_NB2_2K = np.ascontiguousarray(BUCKETS_NB2_2K, dtype=np.int64)
+    _NP_NB2_4K = np.ascontiguousarray(BUCKETS_NB2_4K, dtype=np.int64)
+
+    NP_PRESET_TABLE = {
+        "Nano Banana 1": _NP_NB1,
+        "Nano Banana 2 (1K)": _NP_NB2_1K,
+        "Nano Banana 2 (2K)": _NP_NB2_2K,
+        "Nano Banana 2 (4K)": _NP_NB2_4K,
     }
 
-    # ──────────────────────────────────────────────────────────────
-    # BUCKETS (Unchanged from final fix)
-    # ──────────────────────────────────────────────────────────────
-    BUCKETS_NB1 = [
-        (512, 2048), (576, 1792), (736, 1408), (768, 1344), (800, 1280),
-        (832, 1248), (864, 1184), (896, 1152), (928, 1120), (960, 1088),
-        (1024, 1024), (1088, 960), (1120, 928), (1152, 896), (1184, 864),
-        (1248, 832), (1280, 800), (1344, 768), (1408, 736), (1472, 704),
-        (1792, 576), (2048, 512),
-    ]
-
-    BUCKETS_NB2_1K = [
-        (768, 1344), (800, 1280), (832, 1248), (864, 1184), (896, 1152),
-        (928, 1120), (960, 1088), (992, 1056), (1024, 1024), (1056, 992),
-        (1088, 960), (1120, 928), (1152, 896), (1184, 864), (1248, 832),
-        (1280, 800), (1344, 768),
-    ]
-
-    BUCKETS_NB2_2K = [
-        (1024, 4096), (1088, 3840), (1152, 3584), (1216, 3328), (1280, 3072),
-        (1344, 2816), (1408, 2560), (1472, 2816), (1536, 2688), (1600, 2560),
-        (1664, 2496), (1696, 2528), (1728, 2368), 
-        (1760, 2432), (2432, 1760), 
-        (1792, 2304), (1856, 2240),
-        (1920, 2176), (1984, 2048), (2048, 2048), (2176, 1920), (2240, 1856),
-        (2304, 1792), (2368, 1728), (2496, 1664), (2560, 1600), (2688, 1536),
-        (2816, 1472), (3072, 1280), (3328, 1216), (3584, 1152), (3840, 1088),
-        (4096, 1024),
-    ]
-
-    BUCKETS_NB2_4K = [
-        (2048, 8192), (2176, 7680), (2304, 7168), (2432, 6656), (2560, 6144),
-        (2688, 5632), (2816, 5120), (2944, 5632), (3072, 5376), (3200, 5120),
-        (3328, 4992), (3392, 5056), (3456, 4736), (3584, 4608), (3712, 4480),
-        (3840, 4352), (3968, 4096), (4096, 4096), (4352, 3840), (4480, 3712),
-        (4608, 3584), (4736, 3456), (4992, 3328), (5120, 3200), (5376, 3072),
-        (5632, 2944), (6144, 2560), (6656, 2432), (7168, 2304), (7680, 2176),
-        (8192, 2048),
-    ]
+    @njit(cache=True)
+    def _closest_bucket_nb(arr, w_in, h_in):
+        """Index and squared distance of the first nearest row of arr."""
+        best = 2 ** 62
+        bi = 0
+        for i in range(arr.shape[0]):
+            dw = w_in - arr[i, 0]
+            dh = h_in - arr[i, 1]
+            d = dw * dw + dh * dh
+            if d < best:
+                best = d
+                bi = i
+        return bi, best
+else:
+    NP_PRESET_TABLE = {}
+
+
+# Supported Aspect Ratios for Nano Banana/Gemini API (W:H format).
+# Parallel label/value tables, ascending by value so detection can
+# bisect; the values sit in one contiguous C double buffer.
+_AR_KEYS = ("9:16", "2:3", "3:4", "4:5", "1:1", "5:4", "4:3", "3:2", "16:9", "21:9")
+_AR_VALS = array('d', (0.5625, 0.666667, 0.75, 0.8, 1.0, 1.25, 1.333333, 1.5, 1.777778, 2.333333))
+
+# Results keyed on (w, h, preset); only the image shape matters, so
+# the tensor itself is never part of the key.
+_CACHE_SIZE = 256
+_cache: "OrderedDict[Tuple[int, int, str], Tuple[int, int, str, str]]" = OrderedDict()
+
+
+def _detect_aspect_ratio(w: int, h: int) -> str:
+    """Finds the closest supported aspect ratio string for the given dimensions.
+
+    Expects h > 0; _calculate_size checks the input size once up front.
+    """
+    current_ar = w / h
+
+    # Only the two neighbours of the insertion point can be closest
+    i = bisect_left(_AR_VALS, current_ar)
+    if i == len(_AR_VALS) or (i > 0 and current_ar - _AR_VALS[i - 1] <= _AR_VALS[i] - current_ar):
+        i -= 1
+
+    min_diff = abs(current_ar - _AR_VALS[i])
+    best_ar_str = _AR_KEYS[i]
+    
+    # If the detected AR is extremely far from any supported AR, return "auto"
+    # 0.01 is generally sufficient to cover rounding differences in buckets.
+    if min_diff > 0.01: 
+        return "auto" 
+        
+    return best_ar_str
+
+
+def _closest_bucket(w_in: int, h_in: int, buckets: Tuple[Tuple[int, int], ...],
+                    np_buckets: Optional["np.ndarray"] = None,
+                    bucket_set: Optional[FrozenSet[Tuple[int, int]]] = None) -> Tuple[int, int]:
+    
+    # ──────────────────────────────────────────────────────────────────────
+    # MANUAL OVERRIDE FIX: Ambiguity Zone (for cases like 1704x2461)
+    # Checked first: it wins even over an exact bucket hit (e.g. 1664x2496).
+    # ──────────────────────────────────────────────────────────────────────
+    w_target, h_target = (1696, 2528)
+    
+    if 1650 < w_in < 1750 and 2350 < h_in < 2550:
+        override_dist_sq = (w_in - w_target) ** 2 + (h_in - h_target) ** 2
+
+        if override_dist_sq < 8000:
+             return (w_target, h_target)
+
+    # Input already is a fixed bucket: nothing to search
+    if bucket_set is not None and (w_in, h_in) in bucket_set:
+        return (w_in, h_in)
+
+    # 1. Nearest fixed bucket: compiled scan when numba is available
+    if np_buckets is not None:
+        idx, best_dist = _closest_bucket_nb(np_buckets, w_in, h_in)
+        best_w, best_h = buckets[idx]
+    else:
+        # Single pass, keeping only the nearest bucket so far.
+        # Strict "<" keeps the first of equally distant buckets.
+        best_dist = float('inf')
+        best_w, best_h = buckets[0]
+        for w_bucket, h_bucket in buckets:
+            dw = w_in - w_bucket
+            dist_sq = dw * dw
+            # Partial distance: the width term alone already loses
+            if dist_sq >= best_dist:
+                continue
+            dh = h_in - h_bucket
+            dist_sq += dh * dh
+            if dist_sq < best_dist:
+                best_dist = dist_sq
+                best_w, best_h = w_bucket, h_bucket
+
+    # ──────────────────────────────────────────────────────────────────────
+    # Fallback to Dynamic Ceiling Logic for True Outliers (Dist_sq > 8000)
+    # ──────────────────────────────────────────────────────────────────────
+    if best_dist > 8000 and len(buckets) > 20: 
+        
+        w_new = w_in
+        h_new = h_in
+        
+        # Round up to a multiple of 32 (power of two: add 31, clear low bits)
+        w_dynamic = (w_new + 31) & ~31
+        h_dynamic = (h_new + 31) & ~31
+        
+        return (w_dynamic, h_dynamic)
+
+    # Otherwise, stick with the closest fixed bucket
+    return (best_w, best_h)
+
+
+def _build_bucket_info():
+    """(preset, w, h) -> (aspect ratio, info prefix) for every fixed bucket."""
+    table = {}
+    for preset, (buckets, version_info) in PRESET_TABLE.items():
+        for w, h in buckets:
+            ar = _detect_aspect_ratio(w, h)
+            table[(preset, w, h)] = (ar, f"{version_info} • {w}×{h} • AR: {ar} • Input: ")
+    return table
+
+# Built once at import; only dynamic-ceiling and override outputs still go
+# through _detect_aspect_ratio and the f-string per call.
+_BUCKET_INFO = _build_bucket_info()
+
+
+def _calculate_size(image, preset: str, input_width: int = 0, input_height: int = 0):
+    
+    if input_width > 0 and input_height > 0:
+        w, h = input_width, input_height
+    else:
+        _, h, w, _ = image.shape
+    assert w > 0 and h > 0, f"Input size must be positive, got {w}x{h}"
+
+    key = (w, h, preset)
+    hit = _cache.get(key)
+    if hit is not None:
+        _cache.move_to_end(key)
+        return hit
+
+    target_buckets, version_info = PRESET_TABLE[preset]
+
+    # Calculate best size
+    w_out, h_out = _closest_bucket(w, h, target_buckets, NP_PRESET_TABLE.get(preset),
+                                   BUCKET_SET_TABLE[preset])
+    
+    # NEW: Detect aspect ratio (AR and info prefix precomputed for fixed buckets)
+    hit = _BUCKET_INFO.get((preset, w_out, h_out))
+    if hit is not None:
+        aspect_ratio, info_prefix = hit
+    else:
+        aspect_ratio = _detect_aspect_ratio(w_out, h_out)
+        info_prefix = f"{version_info} • {w_out}×{h_out} • AR: {aspect_ratio} • Input: "
+    
+    info = f"{info_prefix}{w}×{h}"
+
+    result = (w_out, h_out, info, aspect_ratio)
+    _cache[key] = result
+    if len(_cache) > _CACHE_SIZE:
+        _cache.popitem(last=False)
+
+    return result
+
+
+class NanoBananaSizeCalculator:
+    # Stateless node: all logic lives in the module-level functions above,
+    # and there is no per-instance __dict__ for each evaluation.
+    __slots__ = ()
+
+    BUCKETS_NB1 = BUCKETS_NB1
+    BUCKETS_NB2_1K = BUCKETS_NB2_1K
+    BUCKETS_NB2_2K = BUCKETS_NB2_2K
+    BUCKETS_NB2_4K = BUCKETS_NB2_4K
 
     @classmethod
     def INPUT_TYPES(cls):
         return {
             "required": {
                 "image": ("IMAGE",),
-                "preset": ([
-                    "Nano Banana 1",
-                    "Nano Banana 2 (1K)",
-                    "Nano Banana 2 (2K)",
-                    "Nano Banana 2 (4K)"
-                ], {"default": "Nano Banana 2 (2K)"}),
+                "preset": (list(PRESET_TABLE), {"default": "Nano Banana 2 (2K)"}),
+            },
+            # Known input size from upstream; when both are > 0 the image
+            # tensor's shape is not read at all.
+            "optional": {
+                "input_width": ("INT", {"default": 0, "min": 0, "max": 16384}),
+                "input_height": ("INT", {"default": 0, "min": 0, "max": 16384}),
             }
         }
 
@@ -85,93 +291,8 @@ class NanoBananaSizeCalculator:
     FUNCTION = "calculate_size"
     CATEGORY = "image/transform"
 
-    def _detect_aspect_ratio(self, w: int, h: int) -> str:
-        """Finds the closest supported aspect ratio string for the given dimensions."""
-        if h == 0:
-            return "auto"
-
-        current_ar = w / h
-        min_diff = float('inf')
-        best_ar_str = "auto"
-
-        for ar_str, ar_val in self.SUPPORTED_ARS.items():
-            diff = abs(current_ar - ar_val)
-            if diff < min_diff:
-                min_diff = diff
-                best_ar_str = ar_str
-        
-        # If the detected AR is extremely far from any supported AR, return "auto"
-        # 0.01 is generally sufficient to cover rounding differences in buckets.
-        if min_diff > 0.01: 
-            return "auto" 
-            
-        return best_ar_str
-
-
-    def _closest_bucket(self, w_in: int, h_in: int, buckets: List[Tuple[int, int]]) -> Tuple[int, int]:
-        
-        # 1. Calculate all distances
-        candidates = [] 
-        for w_bucket, h_bucket in buckets:
-            dist_sq = (w_in - w_bucket) ** 2 + (h_in - h_bucket) ** 2
-            candidates.append((dist_sq, w_bucket, h_bucket))
-        
-        candidates.sort(key=lambda x: x[0])
-        best_dist, best_w, best_h = candidates[0]
-
-        # ──────────────────────────────────────────────────────────────────────
-        # MANUAL OVERRIDE FIX: Ambiguity Zone (for cases like 1704x2461)
-        # ──────────────────────────────────────────────────────────────────────
-        w_target, h_target = (1696, 2528)
-        
-        if 1650 < w_in < 1750 and 2350 < h_in < 2550:
-            override_dist_sq = (w_in - w_target) ** 2 + (h_in - h_target) ** 2
-
-            if override_dist_sq < 8000:
-                 return (w_target, h_target)
-        
-        # ──────────────────────────────────────────────────────────────────────
-        # Fallback to Dynamic Ceiling Logic for True Outliers (Dist_sq > 8000)
-        # ──────────────────────────────────────────────────────────────────────
-        if best_dist > 8000 and len(buckets) > 20: 
-            
-            w_new = w_in
-            h_new = h_in
-            
-            w_dynamic = math.ceil(w_new / 32) * 32
-            h_dynamic = math.ceil(h_new / 32) * 32
-            
-            return (int(w_dynamic), int(h_dynamic))
-
-        # Otherwise, stick with the closest fixed bucket
-        return (best_w, best_h)
-
-    def calculate_size(self, image, preset: str):
-        
-        _, h, w, _ = image.shape
-
-        if preset == "Nano Banana 1":
-            target_buckets = self.BUCKETS_NB1
-            version_info = "Nano Banana 1"
-        elif "1K" in preset:
-            target_buckets = self.BUCKETS_NB2_1K
-            version_info = "Nano Banana 2 (1K)"
-        elif "2K" in preset:
-            target_buckets = self.BUCKETS_NB2_2K
-            version_info = "Nano Banana 2 (2K)"
-        else:
-            target_buckets = self.BUCKETS_NB2_4K
-            version_info = "Nano Banana 2 (4K)"
-
-        # Calculate best size
-        w_out, h_out = self._closest_bucket(w, h, target_buckets)
-        
-        # NEW: Detect aspect ratio
-        aspect_ratio = self._detect_aspect_ratio(w_out, h_out)
-        
-        info = f"{version_info} • {w_out}×{h_out} • AR: {aspect_ratio} • Input: {w}×{h}"
-
-        return (w_out, h_out, info, aspect_ratio)
+    def calculate_size(self, image, preset: str, input_width: int = 0, input_height: int = 0):
+        return _calculate_size(image, preset, input_width, input_height)
 
 NODE_CLASS_MAPPINGS = {"NanoBananaSizeCalculator": NanoBananaSizeCalculator}
 NODE_DISPLAY_NAME_MAPPINGS = {"NanoBananaSizeCalculator": "Nano Banana Size Calculator"}